@@ -34,14 +34,26 @@ Thanassis Tsiodras
 ttsiodras@gmail.com
 """
 
-import sys
+import os
 import math
+import ctypes
 import pygame
-import random
 from collections import defaultdict
+from dataclasses import dataclass
 import numpy as np
 from time import time
 
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    # No JIT available - the NumPy version of the integrator is used instead
+    HAVE_NUMBA = False
+    prange = range
+
+    def njit(*args, **kwargs):
+        return lambda f: f
+
 from PIL import Image, ImageDraw
 
 # The window size
@@ -57,27 +69,32 @@ ivy = 2
 
 STATICSUN = False
 
+# Let the planets attract each other too (and the suns), not just be
+# attracted by the suns - computed via a Barnes-Hut quadtree, where a cell
+# is treated as a single body when its width/distance ratio is below THETA
+MUTUALGRAVITY = False
+THETA = 0.7
+# Deepest quadtree level - bodies closer than this all share one cell
+QUADTREE_DEPTH = 32
+
 W = 2*MX+1
 H = 2*MY+1
 
 RESIZE = 4
 
-# The number of simulated planets
-PLANETS = 30
-
 # The density of the planets - used to calculate their mass
 # from their volume (i.e. via their radius)
 DENSITY = 0.001
 
 # The gravity coefficient - it's my universe, I can pick whatever I want :-)
-GRAVITYSTRENGTH = 1.e4
+GRAVITYSTRENGTH = np.float32(1.e4)
 
-# The global list of planets
-planets = []
+# The global planet data - the two suns are the last two entries
+planets = None
 
-sun = None
-sun2 = None
+SUN, SUN2 = -2, -1
 
+# The recorded merges, as an H x W x 3 RGB array
 img = None
 
 IDX = 200
@@ -85,170 +102,507 @@ IVX = 15
 IMM = 500
 
 imgarr = None
-colarr = None
-
-class State:
-    """Class representing position and velocity."""
-    def __init__(self, x, y, vx, vy, px, py):
-        self._x, self._y, self._vx, self._vy = x, y, vx, vy
-        self._ix, self._iy = px, py
-
-    def __repr__(self):
-        return 'x:{x} y:{y} vx:{vx} vy:{vy}'.format(
-            x=self._x, y=self._y, vx=self._vx, vy=self._vy)
-
-
-class Derivative:
-    """Class representing velocity and acceleration."""
-    def __init__(self, dx, dy, dvx, dvy):
-        self._dx, self._dy, self._dvx, self._dvy = dx, dy, dvx, dvy
-
-    def __repr__(self):
-        return 'dx:{dx} dy:{dy} dvx:{dvx} dvy:{dvy}'.format(
-            dx=self._dx, dy=self._dy, dvx=self._dvx, dvy=self._dvy)
-
-
-class Planet:
-    """Class representing a planet. The "_st" member is an instance of "State",
-    carrying the planet's position and velocity - while the "_m" and "_r"
-    members represents the planet's mass and radius."""
-    def __init__(self, state=None):
-        if PLANETS == 1:
-            # A nice example of a planet orbiting around our sun :-)
-            self._st = State(150, 300, 0, 2, 0, 0)
-        elif state is None:
-            # otherwise pick a random position and velocity
-            self._st = State(
-               float(random.randint(0, WIDTH)),
-               float(random.randint(0, HEIGHT)),
-               float(random.randint(0, 300)/100.)-1.5,
-               float(random.randint(0, 300)/100.)-1.5,
-               0,0
-               )
-        else:
-            self._st = state
-        self._r = 1.5
-        self.setMassFromRadius()
-        self._merged = False
-
-    def __repr__(self):
-        return repr(self._st)
-
-    def acceleration(self, state, unused_t):
-        """Calculate acceleration caused by other planets on this one."""
-        ax = 0.0
-        ay = 0.0
-        for p in planets[-2:]:
-            if p is self or p._merged:
-                continue  # ignore ourselves and merged planets
-            dx = p._st._x - state._x
-            dy = p._st._y - state._y
-            dsq = dx*dx + dy*dy  # distance squared
-            dr = math.sqrt(dsq)  # distance
-            if dr != 0:
-                force = GRAVITYSTRENGTH*self._m*p._m/dsq if dsq>1e-10 else 0.
-                # Accumulate acceleration...
-                ax += force*dx/dr
-                ay += force*dy/dr
-        return (ax, ay)
-
-    def initialDerivative(self, state, t):
-        """Part of Runge-Kutta method."""
-        ax, ay = self.acceleration(state, t)
-        return Derivative(state._vx, state._vy, ax, ay)
-
-    def nextDerivative(self, initialState, derivative, t, dt):
-        """Part of Runge-Kutta method."""
-        state = State(0., 0., 0., 0., None, None)
-        state._x = initialState._x + derivative._dx*dt
-        state._y = initialState._y + derivative._dy*dt
-        state._vx = initialState._vx + derivative._dvx*dt
-        state._vy = initialState._vy + derivative._dvy*dt
-        ax, ay = self.acceleration(state, t+dt)
-        return Derivative(state._vx, state._vy, ax, ay)
-
-    def updatePlanet(self, t, dt):
-        """Runge-Kutta 4th order solution to update planet's pos/vel."""
-        a = self.initialDerivative(self._st, t)
-        b = self.nextDerivative(self._st, a, t, dt*0.5)
-        c = self.nextDerivative(self._st, b, t, dt*0.5)
-        d = self.nextDerivative(self._st, c, t, dt)
-        dxdt = 1.0/6.0 * (a._dx + 2.0*(b._dx + c._dx) + d._dx)
-        dydt = 1.0/6.0 * (a._dy + 2.0*(b._dy + c._dy) + d._dy)
-        dvxdt = 1.0/6.0 * (a._dvx + 2.0*(b._dvx + c._dvx) + d._dvx)
-        dvydt = 1.0/6.0 * (a._dvy + 2.0*(b._dvy + c._dvy) + d._dvy)
-        self._st._x += dxdt*dt
-        self._st._y += dydt*dt
-        self._st._vx += dvxdt*dt
-        self._st._vy += dvydt*dt
-
-    def setMassFromRadius(self):
-        """From _r, set _m: The volume is (4/3)*Pi*(r^3)..."""
-        self._m = DENSITY*4.*math.pi*(self._r**3.)/3.
-
-    def setRadiusFromMass(self):
-        """Reversing the setMassFromRadius formula, to calculate radius from
-        mass (used after merging of two planets - mass is added, and new
-        radius is calculated from this)"""
-        self._r = (3.*self._m/(DENSITY*4.*math.pi))**(0.3333)
-
-def planetsTouch(p1, p2):
-    dx = p1._st._x - p2._st._x
-    dy = p1._st._y - p2._st._y
+# The colour of the recorded pixels, as separate red/blue channels - "mask"
+# marks the pixels that have been recorded at all
+red = None
+blue = None
+mask = None
+
+@dataclass
+class Planets:
+    """Structure of arrays, carrying the position ("x", "y") and velocity
+    ("vx", "vy") of all planets - while "m" and "r" hold their mass and
+    radius. "ix" and "iy" are the pixel each planet is recorded at when
+    merged into a sun, and "merged" (a byte per planet) is non-zero once it
+    has been. The numbers are single precision: plenty for a simulation
+    that is rendered at pixel resolution."""
+    x: np.ndarray
+    y: np.ndarray
+    vx: np.ndarray
+    vy: np.ndarray
+    m: np.ndarray
+    r: np.ndarray
+    merged: np.ndarray
+    ix: np.ndarray
+    iy: np.ndarray
+
+
+def massFromRadius(r):
+    """The volume is (4/3)*Pi*(r^3)..."""
+    return DENSITY*4.*math.pi*(r**3.)/3.
+
+
+def radiusFromMass(m):
+    """Reversing the massFromRadius formula, to calculate radius from
+    mass (used for the suns, whose mass is scaled up)"""
+    return (3.*m/(DENSITY*4.*math.pi))**(0.3333)
+
+
+def loadRK4Library():
+    """Load the C version of stepRK4 from rk4.so, if it has been built (see
+    rk4.c) - it takes the arrays as pointers, plus their length."""
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rk4.so')
+    try:
+        lib = ctypes.CDLL(path)
+    except OSError:
+        return None
+    floats = ctypes.POINTER(ctypes.c_float)
+    lib.stepRK4.restype = None
+    lib.stepRK4.argtypes = [floats]*6 + [ctypes.POINTER(ctypes.c_ubyte)]*2 + \
+        [ctypes.c_float]*16 + [ctypes.c_ssize_t]
+    return lib.stepRK4
+
+
+# Only needed when numba isn't there to compile stepRK4
+stepRK4C = None if HAVE_NUMBA else loadRK4Library()
+
+
+def makeSunsAcceleration(sx, sy, sm, sx2, sy2, sm2):
+    """Specialize the acceleration to exactly two attractors, the suns at
+    (sx, sy) and (sx2, sy2) with masses sm and sm2 - no loop over the
+    attractors, and their constants are folded in once per step."""
+    gm = GRAVITYSTRENGTH*sm
+    gm2 = GRAVITYSTRENGTH*sm2
+
+    def acceleration(x, y, m):
+        """Calculate acceleration caused by the suns on the planets at x, y
+        with masses m."""
+        dx = sx - x
+        dy = sy - y
+        dsq = dx*dx + dy*dy  # distance squared
+        dx2 = sx2 - x
+        dy2 = sy2 - y
+        dsq2 = dx2*dx2 + dy2*dy2
+        with np.errstate(divide='ignore'):
+            force = gm*m*np.where(dsq > 1e-10, dsq**-1.5, 0.)
+            force2 = gm2*m*np.where(dsq2 > 1e-10, dsq2**-1.5, 0.)
+        return (force*dx + force2*dx2, force*dy + force2*dy2)
+    return acceleration
+
+
+def updatePlanets(x, y, vx, vy, m, acceleration, dt, dt2, dt6):
+    """Runge-Kutta 4th order solution to update the planets' pos/vel,
+    in place. The four derivatives are plain arrays (a_dx is just vx)."""
+    a_dvx, a_dvy = acceleration(x, y, m)
+    b_dx, b_dy = vx + a_dvx*dt2, vy + a_dvy*dt2
+    b_dvx, b_dvy = acceleration(x + vx*dt2, y + vy*dt2, m)
+    c_dx, c_dy = vx + b_dvx*dt2, vy + b_dvy*dt2
+    c_dvx, c_dvy = acceleration(x + b_dx*dt2, y + b_dy*dt2, m)
+    d_dx, d_dy = vx + c_dvx*dt, vy + c_dvy*dt
+    d_dvx, d_dvy = acceleration(x + c_dx*dt, y + c_dy*dt, m)
+    x += dt6 * (vx + 2.0*(b_dx + c_dx) + d_dx)
+    y += dt6 * (vy + 2.0*(b_dy + c_dy) + d_dy)
+    vx += dt6 * (a_dvx + 2.0*(b_dvx + c_dvx) + d_dvx)
+    vy += dt6 * (a_dvy + 2.0*(b_dvy + c_dvy) + d_dvy)
+
+
+@njit('UniTuple(f4, 2)(f4, f4, f4, f4, f4, f4, f4, f4, f4, f4)',
+      fastmath=True, cache=True)
+def sunsAcceleration(x, y, m, sx, sy, sm, sx2, sy2, sm2, G):
+    """Calculate acceleration caused by the two suns on a single planet."""
+    ax = np.float32(0.0)
+    ay = np.float32(0.0)
+    dx = sx - x
+    dy = sy - y
+    dsq = dx*dx + dy*dy  # distance squared
+    if dsq > 1e-10:
+        force = G*m*sm*dsq**np.float32(-1.5)
+        ax += force*dx
+        ay += force*dy
+    dx = sx2 - x
+    dy = sy2 - y
     dsq = dx*dx + dy*dy
-    dr = math.sqrt(dsq)
-    return dr<=(p1._r + p2._r)
-
-def initialize():
-    global img, sun, sun2, planets, PLANETS, imgarr, colarr
-    if len(sys.argv) == 2:
-        PLANETS = int(sys.argv[1])
-
-    # And God said: Let there be lights in the firmament of the heavens...
-    planets = []
-    #for i in range(0, PLANETS):
-
-    for x in range(-MX, MX+1):
-        for y in range(-MY, MY+1):
-            state = State(WIDTHD2, HEIGHTD2, x*SCALE, y*SCALE, x+MX, y+MY)
-            planets.append(Planet(state))
-
-    imgarr = np.array([[0 for x in range(W)] for y in range(H)])
-    colarr = [[None for x in range(W)] for y in range(H)]
+    if dsq > 1e-10:
+        force = G*m*sm2*dsq**np.float32(-1.5)
+        ax += force*dx
+        ay += force*dy
+    return (ax, ay)
+
+
+@njit('void(f4[:], f4[:], f4[:], f4[:], f4[:], f4[:], u1[:], u1[:], '
+      'f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4, f4)',
+      parallel=True, fastmath=True, cache=True)
+def stepRK4(x, y, vx, vy, m, r, merged, hit, sx, sy, sm, sx2, sy2, sm2,
+            G, dt, dt2, dt6, tx, ty, tr, tx2, ty2, tr2):
+    """Runge-Kutta 4th order solution to update the planets' pos/vel in
+    place, with the two suns (sx, sy, sm) and (sx2, sy2, sm2) attracting
+    them. Compiled by numba, and run in parallel over all planets.
+    The constants are float32 too, so nothing is promoted to double.
+
+    While each planet's new position is at hand, it is also tested against
+    the suns' new positions (tx, ty) and (tx2, ty2) with radii tr and tr2
+    (negative for a merged sun): hit is set to 1 or 2 if the planet touches
+    the first or second sun, 0 otherwise."""
+    two = np.float32(2.0)
+    for i in prange(len(x)):
+        hit[i] = 0
+        if merged[i]:
+            continue
+        x0, y0, vx0, vy0, m0 = x[i], y[i], vx[i], vy[i], m[i]
+        a_dvx, a_dvy = sunsAcceleration(
+            x0, y0, m0, sx, sy, sm, sx2, sy2, sm2, G)
+        b_dx, b_dy = vx0 + a_dvx*dt2, vy0 + a_dvy*dt2
+        b_dvx, b_dvy = sunsAcceleration(
+            x0 + vx0*dt2, y0 + vy0*dt2, m0, sx, sy, sm, sx2, sy2, sm2, G)
+        c_dx, c_dy = vx0 + b_dvx*dt2, vy0 + b_dvy*dt2
+        c_dvx, c_dvy = sunsAcceleration(
+            x0 + b_dx*dt2, y0 + b_dy*dt2, m0, sx, sy, sm, sx2, sy2, sm2, G)
+        d_dx, d_dy = vx0 + c_dvx*dt, vy0 + c_dvy*dt
+        d_dvx, d_dvy = sunsAcceleration(
+            x0 + c_dx*dt, y0 + c_dy*dt, m0, sx, sy, sm, sx2, sy2, sm2, G)
+        x0 += dt6 * (vx0 + two*(b_dx + c_dx) + d_dx)
+        y0 += dt6 * (vy0 + two*(b_dy + c_dy) + d_dy)
+        x[i] = x0
+        y[i] = y0
+        vx[i] = vx0 + dt6 * (a_dvx + two*(b_dvx + c_dvx) + d_dvx)
+        vy[i] = vy0 + dt6 * (a_dvy + two*(b_dvy + c_dvy) + d_dvy)
+        dx, dy = x0 - tx, y0 - ty
+        dx2, dy2 = x0 - tx2, y0 - ty2
+        if tr >= 0 and dx*dx + dy*dy <= (r[i] + tr)*(r[i] + tr):
+            hit[i] = 1
+        elif tr2 >= 0 and dx2*dx2 + dy2*dy2 <= (r[i] + tr2)*(r[i] + tr2):
+            hit[i] = 2
+
+
+@njit(cache=True)
+def buildQuadTree(x, y, m, cx, cy, half, child, body, mass, mx, my):
+    """Insert the bodies into the flat quadtree arrays, whose root cell
+    (node 0) is already set up. Returns the number of nodes used, or -1 if
+    the arrays are too small."""
+    count = 1
+    for i in range(len(x)):
+        node = 0
+        level = 0
+        while True:
+            if child[node] >= 0:
+                # An internal cell: accumulate, and go down to the quadrant
+                mass[node] += m[i]
+                mx[node] += m[i]*x[i]
+                my[node] += m[i]*y[i]
+                q = 0
+                if x[i] >= cx[node]:
+                    q += 1
+                if y[i] >= cy[node]:
+                    q += 2
+                node = child[node] + q
+                level += 1
+                continue
+            if body[node] == -1 or level >= QUADTREE_DEPTH:
+                # An empty leaf takes the body; at the deepest level, they
+                # just pile up (body -2 means "more than one")
+                body[node] = i if body[node] == -1 else -2
+                mass[node] += m[i]
+                mx[node] += m[i]*x[i]
+                my[node] += m[i]*y[i]
+                break
+            # A leaf with a body already in it: split it in four, and move
+            # its body down to the quadrant it belongs to
+            if count + 4 > len(child):
+                return -1
+            first = count
+            count += 4
+            h = half[node]*0.5
+            for q in range(4):
+                c = first + q
+                cx[c] = cx[node] + (h if q & 1 else -h)
+                cy[c] = cy[node] + (h if q & 2 else -h)
+                half[c] = h
+            child[node] = first
+            j = body[node]
+            body[node] = -1
+            q = 0
+            if x[j] >= cx[node]:
+                q += 1
+            if y[j] >= cy[node]:
+                q += 2
+            c = first + q
+            body[c] = j
+            mass[c] = m[j]
+            mx[c] = m[j]*x[j]
+            my[c] = m[j]*y[j]
+    return count
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def quadTreeAcceleration(child, body, mass, mx, my, half, x, y, m, ids,
+                         theta, G, ax, ay):
+    """Calculate acceleration caused by the bodies in the quadtree on the
+    planets at x, y with masses m, into ax, ay. ids is each planet's own
+    body in the tree (-1 if not in it), so it doesn't attract itself - but
+    a piled leaf (body -2) still includes the planet's own mass; those
+    only hold bodies that are practically on top of each other."""
+    theta2 = theta*theta
+    # The planets are handed out in chunks, each walking the tree with one
+    # stack - rather than allocating a stack per planet
+    chunk = 256
+    for c in prange((len(x) + chunk - 1)//chunk):
+        stack = np.empty(4*(QUADTREE_DEPTH+1), dtype=np.int64)
+        for i in range(c*chunk, min(len(x), (c+1)*chunk)):
+            stack[0] = 0
+            sp = 1
+            fx = 0.0
+            fy = 0.0
+            while sp > 0:
+                sp -= 1
+                node = stack[sp]
+                if mass[node] == 0:
+                    continue
+                dx = mx[node]/mass[node] - x[i]
+                dy = my[node]/mass[node] - y[i]
+                dsq = dx*dx + dy*dy  # distance squared
+                width = 2.0*half[node]
+                leaf = child[node] < 0
+                if leaf or width*width < theta2*dsq:
+                    # A leaf, or far enough to be treated as a single body
+                    if leaf and body[node] == ids[i]:
+                        continue  # ignore ourselves
+                    if dsq > 1e-10:
+                        force = G*m[i]*mass[node]*dsq**-1.5
+                        fx += force*dx
+                        fy += force*dy
+                else:
+                    for q in range(4):
+                        stack[sp] = child[node] + q
+                        sp += 1
+            ax[i] = fx
+            ay[i] = fy
+
+
+class QuadTree:
+    """Barnes-Hut quadtree over the bodies at x, y with masses m, stored in
+    flat arrays: node 0 is the root cell, and the four children of a cell
+    are stored contiguously, starting at _child[node] (-1 for leaves).
+    _body is the leaf's body (-1: empty), and _mass, _mx, _my hold each
+    cell's total mass and mass-weighted position sums."""
+    def __init__(self, x, y, m):
+        size = 4*len(x) + 1
+        while True:
+            self._cx = np.zeros(size)
+            self._cy = np.zeros(size)
+            self._half = np.zeros(size)
+            self._child = np.full(size, -1, dtype=np.int64)
+            self._body = np.full(size, -1, dtype=np.int64)
+            self._mass = np.zeros(size)
+            self._mx = np.zeros(size)
+            self._my = np.zeros(size)
+            if len(x):
+                self._cx[0] = (x.min() + x.max())/2.
+                self._cy[0] = (y.min() + y.max())/2.
+                self._half[0] = max(
+                    x.max() - x.min(), y.max() - y.min())/2. + 1e-3
+            count = buildQuadTree(
+                x, y, m, self._cx, self._cy, self._half, self._child,
+                self._body, self._mass, self._mx, self._my)
+            if count >= 0:
+                break
+            size *= 2
+
+    def acceleration(self, x, y, m, ids):
+        """Calculate acceleration caused by the bodies in the tree on the
+        planets at x, y with masses m - ids being their own bodies."""
+        ax = np.zeros_like(x)
+        ay = np.zeros_like(y)
+        quadTreeAcceleration(
+            self._child, self._body, self._mass, self._mx, self._my,
+            self._half, x, y, m, ids, THETA, GRAVITYSTRENGTH, ax, ay)
+        return (ax, ay)
 
-    img = Image.new("RGB", (W,H), color=(0,0,0))
 
-    sun = Planet(State(WIDTHD2, HEIGHTD2-IDX, -IVX, 0, 0, 0))
-    sun._m *= IMM
-    sun.setRadiusFromMass()
-    planets.append(sun)
+def addMutualGravity(acceleration, tree, ids):
+    """Extend acceleration with the pull of the bodies in the tree."""
+    def mutualAcceleration(x, y, m):
+        ax, ay = acceleration(x, y, m)
+        tx, ty = tree.acceleration(x, y, m, ids)
+        return (ax + tx, ay + ty)
+    return mutualAcceleration
+
+
+def sunState(s):
+    """The (x, y, m) of sun s - a merged sun no longer attracts anyone."""
+    p = planets
+    return (p.x[s], p.y[s], 0. if p.merged[s] else p.m[s])
+
+
+def sunTouch(s):
+    """The (x, y, r) of sun s, for the touch test - r is -1 once merged."""
+    p = planets
+    return (p.x[s], p.y[s], np.float32(-1) if p.merged[s] else p.r[s])
+
+
+def stepPlanets(dt, dt2, dt6, active):
+    """Update all (active) planets' positions and speeds - dt2 and dt6 are
+    dt/2 and dt/6, computed once per frame. Returns which sun (1 or 2) each
+    planet touches, or None if that is left to mergePlanets."""
+    p = planets
+    # Read once up front, so every planet sees the same sun positions
+    suns = sunState(SUN) + sunState(SUN2)
+    tree = idx = None
+    if MUTUALGRAVITY:
+        # The tree is built once per step, from the current positions
+        idx = np.nonzero(active[:SUN])[0]
+        tree = QuadTree(p.x[idx], p.y[idx], p.m[idx])
+    if not STATICSUN:
+        # Each sun is only pulled by the other one
+        for s, other in ((SUN, SUN2), (SUN2, SUN)):
+            if p.merged[s]:
+                continue
+            one = slice(len(p.x)+s, len(p.x)+s+1)
+            st = [a[one] for a in (p.x, p.y, p.vx, p.vy, p.m)]
+            acceleration = makeSunsAcceleration(
+                *sunState(other), 0., 0., 0.)
+            if tree is not None:
+                acceleration = addMutualGravity(
+                    acceleration, tree, np.array([-1]))
+            updatePlanets(*st, acceleration, dt, dt2, dt6)
+    if not MUTUALGRAVITY and (HAVE_NUMBA or stepRK4C is not None):
+        hit = np.empty(len(p.x) + SUN, dtype=np.uint8)
+        touch = sunTouch(SUN) + sunTouch(SUN2)
+        if HAVE_NUMBA:
+            stepRK4(p.x[:SUN], p.y[:SUN], p.vx[:SUN], p.vy[:SUN], p.m[:SUN],
+                    p.r[:SUN], p.merged[:SUN], hit, *suns, GRAVITYSTRENGTH,
+                    dt, dt2, dt6, *touch)
+        else:
+            floats = ctypes.POINTER(ctypes.c_float)
+            bytes_ = ctypes.POINTER(ctypes.c_ubyte)
+            stepRK4C(*[a[:SUN].ctypes.data_as(floats)
+                       for a in (p.x, p.y, p.vx, p.vy, p.m, p.r)],
+                     p.merged[:SUN].ctypes.data_as(bytes_),
+                     hit.ctypes.data_as(bytes_),
+                     *[float(v) for v in suns], float(GRAVITYSTRENGTH),
+                     float(dt), float(dt2), float(dt6),
+                     *[float(v) for v in touch], len(hit))
+        return hit
+    # Gather the planets that are still around, update them and scatter
+    # them back
+    if idx is None:
+        idx = np.nonzero(active[:SUN])[0]
+    x, y, vx, vy, m = p.x[idx], p.y[idx], p.vx[idx], p.vy[idx], p.m[idx]
+    acceleration = makeSunsAcceleration(*suns)
+    if tree is not None:
+        acceleration = addMutualGravity(
+            acceleration, tree, np.arange(len(idx)))
+    updatePlanets(x, y, vx, vy, m, acceleration, dt, dt2, dt6)
+    p.x[idx], p.y[idx], p.vx[idx], p.vy[idx] = x, y, vx, vy
+    return None
+
+
+def recordMerges(idx, which, tick):
+    """Mark the planets at idx as merged into the suns given by which (1 for
+    SUN, 2 for SUN2), and remember when. Returns how many they were."""
+    p = planets
+    p.merged[idx] = 1
+    iy, ix = p.iy[idx], p.ix[idx]
+    imgarr[iy, ix] = tick
+    red[iy, ix] = np.where(which == 2, 255, 0)
+    blue[iy, ix] = np.where(which == 1, 255, 0)
+    mask[iy, ix] = True
+    return len(idx)
+
+
+def mergePlanets(tick, active, hit=None):
+    """See if we should merge the (active) ones that are close enough to
+    touch the suns (the suns are always the biggest ones, mass-wise) -
+    unless stepPlanets already found out, in hit. Returns the number of
+    planets merged."""
+    p = planets
+    if hit is None:
+        hit = np.zeros(len(p.x) + SUN, dtype=np.uint8)
+        # SUN goes last, so it gets the planets touching both suns - a
+        # merged sun swallows nothing
+        for s, code in ((SUN2, 2), (SUN, 1)):
+            if p.merged[s]:
+                continue
+            dx = p.x[:SUN] - p.x[s]
+            dy = p.y[:SUN] - p.y[s]
+            hit[(dx*dx + dy*dy) <= (p.r[:SUN] + p.r[s])**2] = code
+    idx = np.nonzero((hit != 0) & active[:SUN])[0]
+    merges = recordMerges(idx, hit[idx], tick)
+    # Only then the suns themselves, as they come last in the list
+    if not (p.merged[SUN] or p.merged[SUN2]):
+        dx = p.x[SUN] - p.x[SUN2]
+        dy = p.y[SUN] - p.y[SUN2]
+        if dx*dx + dy*dy <= (p.r[SUN] + p.r[SUN2])**2:
+            # The smaller sun gets swallowed by the bigger one (recorded
+            # red, as SUN2 is always part of it)
+            loser = SUN if p.m[SUN] < p.m[SUN2] else SUN2
+            merges += recordMerges([len(p.x)+loser], np.array([2]), tick)
+    return merges
 
-    sun2 = Planet(State(WIDTHD2, HEIGHTD2+IDX, IVX, 0, 0, 0))
-    sun2._m *= IMM*0.5
-    sun2.setRadiusFromMass()
-    planets.append(sun2)
 
-    """
-    for p in planets:
-        if p is sun:
-            continue
-        if planetsTouch(p, sun):
-            p._merged = True  # ignore planets inside the sun
-    """
+def initialize():
+    global img, planets, imgarr, red, blue, mask
 
-def pilImageToSurface(pilImage):
-    return pygame.image.fromstring(
-        pilImage.tobytes(), pilImage.size, pilImage.mode).convert()
+    # And God said: Let there be lights in the firmament of the heavens...
+    gx, gy = np.meshgrid(np.arange(-MX, MX+1), np.arange(-MY, MY+1),
+                         indexing='ij')
+    gx, gy = gx.ravel(), gy.ravel()
+    n = len(gx)
+
+    m = massFromRadius(1.5)
+    f32 = dict(dtype=np.float32)
+    # The two suns go last
+    planets = Planets(
+        x=np.concatenate([np.full(n, WIDTHD2), [WIDTHD2, WIDTHD2]], **f32),
+        y=np.concatenate([np.full(n, HEIGHTD2),
+                          [HEIGHTD2-IDX, HEIGHTD2+IDX]], **f32),
+        vx=np.concatenate([gx*SCALE, [-IVX, IVX]], **f32),
+        vy=np.concatenate([gy*SCALE, [0., 0.]], **f32),
+        m=np.concatenate([np.full(n, m), [m*IMM, m*IMM*0.5]], **f32),
+        r=np.full(n+2, 1.5, **f32),
+        merged=np.zeros(n+2, dtype=np.uint8),
+        ix=np.concatenate([gx+MX, [0, 0]]),
+        iy=np.concatenate([gy+MY, [0, 0]]))
+    planets.r[SUN:] = radiusFromMass(planets.m[SUN:])
+
+    imgarr = np.zeros((H, W), dtype=np.int32)
+    red = np.zeros((H, W), dtype=np.uint8)
+    blue = np.zeros((H, W), dtype=np.uint8)
+    mask = np.zeros((H, W), dtype=bool)
+
+    img = np.zeros((H, W, 3), dtype=np.uint8)
+
+def saveImage(rgb, filename):
+    # PIL reads the pixels straight from the array's buffer
+    Image.frombuffer("RGB", (W, H), rgb, "raw", "RGB", 0, 1).save(filename)
 
 def lognormalize(arr):
-    arr = np.array([[math.log(1+arr[y][x]) for x in range(W)] for y in range(H)])
-    return normalize(arr)
+    return normalize(np.log1p(arr))
 
 def normalize(arr):
-    return ((arr - arr.min()) * (1/(arr.max() - arr.min()) * 255)).astype('uint8')
+    lo, hi = arr.min(), arr.max()
+    if hi == lo:
+        return np.zeros(arr.shape, dtype=np.uint8)
+    return ((arr - lo) * (255.0/(hi - lo))).astype(np.uint8)
+
+def renderImage(normalized):
+    """Update the image of the recorded merges in place: red/blue tells
+    which sun swallowed the planet, green how late that happened."""
+    np.stack((red, normalized*mask, blue), axis=-1, out=img)
+
+def drawPlanets(win, zoom, active):
+    """For the active planets (not merged), draw a circle based on their
+    radius, but take zoom factor into account. The radius-1 circles (i.e.
+    2x2 squares) that make up almost all of them are written straight into
+    the window's pixels; only the bigger ones go through pygame.draw."""
+    p = planets
+    # Zoom around the center of the window
+    sx = (WIDTHD2 + zoom*(p.x[active] - WIDTHD2)).astype(np.int32)
+    sy = (HEIGHTD2 + zoom*(p.y[active] - HEIGHTD2)).astype(np.int32)
+    radius = (p.r[active]*zoom).astype(np.int32)
+    dots = radius == 1
+    dx, dy = sx[dots], sy[dots]
+    pixels = pygame.surfarray.pixels3d(win)
+    for ox, oy in ((-1, -1), (0, -1), (-1, 0), (0, 0)):
+        px, py = dx + ox, dy + oy
+        visible = (px >= 0) & (px < WIDTH) & (py >= 0) & (py < HEIGHT)
+        pixels[px[visible], py[visible]] = 255
+    del pixels  # unlocks the window
+    big = radius > 1
+    for px, py, pr in zip(sx[big].tolist(), sy[big].tolist(),
+                          radius[big].tolist()):
+        pygame.draw.circle(win, (255, 255, 255), (px, py), pr, 0)
 
 def main():
-    global img, colarr
     pygame.init()
     win=pygame.display.set_mode((WIDTH, HEIGHT))
 
@@ -265,80 +619,51 @@ def main():
 
     initialize()
 
+    # The merges image is drawn from this surface, updated in place
+    imgsurf = pygame.Surface((W, H))
+
     # Zoom factor, changed at runtime via the '+' and '-' numeric keypad keys
     zoom = 1.0
     # t and dt are unused in this simulation, but are in general,
     # parameters of engine (acceleration may depend on them)
-    t, dt = 0., 1
+    t, dt = 0., np.float32(1)
 
     bClearScreen = True
-    pygame.display.set_caption('Gravity simulation (SPACE: show orbits, '
-                       'keypad +/- : zoom in/out)')
+
+    def SetCaption():
+        verb = "show" if bClearScreen else "hide"
+        pygame.display.set_caption(
+            'Gravity simulation (SPACE: '
+            '%s orbits, keypad +/- : zoom in/out) dt=%g' % (verb, dt))
+
+    SetCaption()
 
     tick = 0
 
     while True:
         tick += 1
         t += dt
-        pygame.display.flip()
         if bClearScreen:  # Show orbits or not?
             win.fill((0, 0, 0))
-        #win.lock()
-
-        if img is not None:
-            imgsurf = pilImageToSurface(img)
-            win.blit(imgsurf, imgsurf.get_rect(center=(ix,iy)))
-
-        for pindex, p in enumerate(planets):
-            if not p._merged:#XXX and pindex % 100 == 0:  # for planets that have not been merged, draw a
-                # circle based on their radius, but take zoom factor into account
-                pygame.draw.circle(win, (255, 255, 255),
-                    (int(WIDTHD2+zoom*WIDTHD2*(p._st._x-WIDTHD2)/WIDTHD2),
-                     int(HEIGHTD2+zoom*HEIGHTD2*(p._st._y-HEIGHTD2)/HEIGHTD2)),
-                     int(p._r*zoom), 0)
-        win.unlock()
+
+        win.blit(imgsurf, imgsurf.get_rect(center=(ix,iy)))
+
+        # The planets that haven't merged (yet)
+        active = planets.merged == 0
+
+        drawPlanets(win, zoom, active)
+        pygame.display.flip()
         ScanKeyboard()
 
-        # Update all planets' positions and speeds (should normally double
-        # buffer the list of planet data, but turns out this is good enough :-)
-        for p in planets:
-            if p._merged or (STATICSUN and (p is sun or p is sun2)):
-                continue
-            # Calculate the contributions of all the others to its acceleration
-            # (via the gravity force) and update its position and velocity
-            p.updatePlanet(t, dt)
-
-        # See if we should merge the ones that are close enough to touch,
-        # using elastic collisions (conservation of total momentum)
-        for p1 in planets:
-            if p1._merged:
-                continue
-            for p2 in planets[-2:]:
-                if p1 is p2 or p2._merged:
-                    continue
-                if planetsTouch(p1, p2):
-                    if p1._m < p2._m:
-                        p1, p2 = p2, p1  # p1 is the biggest one (mass-wise)
-                    p2._merged = True
-                    imgarr[p2._st._iy][p2._st._ix] = tick
-                    colarr[p2._st._iy][p2._st._ix] = (255,0,0) if planets[-1] in [p1, p2]  else (0,0,255)
-                    #img.putpixel((p2._st._ix, p2._st._iy), (0,255,0))
-                    if p1 is sun or p1 is sun2:
-                        continue  # No-one can move the sun :-)
-                    #newvx = (p1._st._vx*p1._m+p2._st._vx*p2._m)/(p1._m+p2._m)
-                    #newvy = (p1._st._vy*p1._m+p2._st._vy*p2._m)/(p1._m+p2._m)
-                    #p1._m += p2._m  # maintain the mass (just add them)
-                    #p1.setRadiusFromMass()  # new mass --> new radius
-                    #p1._st._vx, p1._st._vy = newvx, newvy
-
-        normalized = lognormalize(imgarr)
-
-        for y in range(H):
-            for x in range(W):
-                col = colarr[y][x]
-                if col:
-                    red, _, blue = col
-                    img.putpixel((x,y), (red,normalized[y][x],blue))
+        # Update all planets' positions and speeds
+        hit = stepPlanets(dt, dt*0.5, dt/6.0, active)
+
+        # See if we should merge the ones that are close enough to touch
+        # (the merges image only changes when that happens)
+        if mergePlanets(tick, active, hit):
+            renderImage(lognormalize(imgarr))
+            # pygame arrays are indexed [x][y]
+            pygame.surfarray.blit_array(imgsurf, img.swapaxes(0, 1))
 
         # update zoom factor (numeric keypad +/- keys)
         if keysPressed[pygame.K_KP_PLUS]:
@@ -351,26 +676,26 @@ def main():
             while keysPressed[pygame.K_SPACE]:
                 ScanKeyboard()
             bClearScreen = not bClearScreen
-            verb = "show" if bClearScreen else "hide"
-            pygame.display.set_caption(
-                'Gravity simulation (SPACE: '
-                '%s orbits, keypad +/- : zoom in/out)' % verb)
+            SetCaption()
 
         if keysPressed[pygame.K_q]:
-            img.save(f"{int(time())}.png")
+            saveImage(img, f"{int(time())}.png")
             #img = img.resize((W*RESIZE, H*RESIZE))
             #img.show()
             pygame.quit()
 
         if keysPressed[pygame.K_r]:
             initialize()
+            imgsurf.fill((0, 0, 0))
 
         if keysPressed[pygame.K_UP]:
             dt *= 2
         elif keysPressed[pygame.K_DOWN]:
             dt /= 2
 
-        print(dt)
+        # Report dt in the title bar - but not every frame
+        if tick % 60 == 0:
+            SetCaption()
 
 if __name__ == "__main__":
     main()
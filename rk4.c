@@ -0,0 +1,89 @@
+/*
+ * The planets' Runge-Kutta 4th order step - the same as stepRK4 in main.py,
+ * for when numba isn't available. main.py loads it (via ctypes) from rk4.so,
+ * next to it, if it has been built with:
+ *
+ *     cc -O3 -ffast-math -fopenmp -fPIC -shared -o rk4.so rk4.c
+ *
+ * (drop -fopenmp for a single-threaded build).
+ */
+#include <math.h>
+#include <stddef.h>
+
+/* Calculate acceleration caused by the two suns on a single planet. */
+static inline void sunsAcceleration(
+    float x, float y, float m,
+    float sx, float sy, float sm, float sx2, float sy2, float sm2, float G,
+    float *ax, float *ay)
+{
+    float dx = sx - x, dy = sy - y;
+    float dsq = dx*dx + dy*dy;  /* distance squared */
+    *ax = *ay = 0.f;
+    if (dsq > 1e-10f) {
+        float force = G*m*sm/(dsq*sqrtf(dsq));
+        *ax += force*dx;
+        *ay += force*dy;
+    }
+    dx = sx2 - x;
+    dy = sy2 - y;
+    dsq = dx*dx + dy*dy;
+    if (dsq > 1e-10f) {
+        float force = G*m*sm2/(dsq*sqrtf(dsq));
+        *ax += force*dx;
+        *ay += force*dy;
+    }
+}
+
+/* The arguments, and the touch test filling hit, are as in main.py. */
+void stepRK4(
+    float *x, float *y, float *vx, float *vy, const float *m, const float *r,
+    const unsigned char *merged, unsigned char *hit,
+    float sx, float sy, float sm, float sx2, float sy2, float sm2,
+    float G, float dt, float dt2, float dt6,
+    float tx, float ty, float tr, float tx2, float ty2, float tr2,
+    ptrdiff_t n)
+{
+    ptrdiff_t i;
+
+    /* Every planet only reads the suns' state, so they're independent */
+#pragma omp parallel for schedule(static)
+    for (i = 0; i < n; i++) {
+        float x0, y0, vx0, vy0, m0;
+        float a_dvx, a_dvy, b_dx, b_dy, b_dvx, b_dvy;
+        float c_dx, c_dy, c_dvx, c_dvy, d_dx, d_dy, d_dvx, d_dvy;
+        float dx, dy, dx2, dy2;
+
+        hit[i] = 0;
+        if (merged[i])
+            continue;
+        x0 = x[i]; y0 = y[i]; vx0 = vx[i]; vy0 = vy[i]; m0 = m[i];
+        sunsAcceleration(x0, y0, m0, sx, sy, sm, sx2, sy2, sm2, G,
+                         &a_dvx, &a_dvy);
+        b_dx = vx0 + a_dvx*dt2;
+        b_dy = vy0 + a_dvy*dt2;
+        sunsAcceleration(x0 + vx0*dt2, y0 + vy0*dt2, m0,
+                         sx, sy, sm, sx2, sy2, sm2, G, &b_dvx, &b_dvy);
+        c_dx = vx0 + b_dvx*dt2;
+        c_dy = vy0 + b_dvy*dt2;
+        sunsAcceleration(x0 + b_dx*dt2, y0 + b_dy*dt2, m0,
+                         sx, sy, sm, sx2, sy2, sm2, G, &c_dvx, &c_dvy);
+        d_dx = vx0 + c_dvx*dt;
+        d_dy = vy0 + c_dvy*dt;
+        sunsAcceleration(x0 + c_dx*dt, y0 + c_dy*dt, m0,
+                         sx, sy, sm, sx2, sy2, sm2, G, &d_dvx, &d_dvy);
+        x0 += dt6*(vx0 + 2.f*(b_dx + c_dx) + d_dx);
+        y0 += dt6*(vy0 + 2.f*(b_dy + c_dy) + d_dy);
+        x[i] = x0;
+        y[i] = y0;
+        vx[i] = vx0 + dt6*(a_dvx + 2.f*(b_dvx + c_dvx) + d_dvx);
+        vy[i] = vy0 + dt6*(a_dvy + 2.f*(b_dvy + c_dvy) + d_dvy);
+        dx = x0 - tx;
+        dy = y0 - ty;
+        dx2 = x0 - tx2;
+        dy2 = y0 - ty2;
+        if (tr >= 0.f && dx*dx + dy*dy <= (r[i] + tr)*(r[i] + tr))
+            hit[i] = 1;
+        else if (tr2 >= 0.f && dx2*dx2 + dy2*dy2 <= (r[i] + tr2)*(r[i] + tr2))
+            hit[i] = 2;
+    }
+}